@@ -0,0 +1,220 @@
+"""
+.tbl 文本文件 -> PostgreSQL COPY BINARY 格式转换。
+
+二进制 COPY 免去服务端逐字段的文本解析 (时间戳、EWKB 十六进制、整数)，
+列顺序与文本导入一致: fid, geom, dtg, taxi_id。
+"""
+import os
+import re
+import struct
+import logging
+from datetime import datetime, timezone
+from pathlib import Path
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+import click
+
+BINARY_SUFFIX = ".bin"
+
+# 文件头: 11 字节签名 + flags(int32) + 头扩展长度(int32)；文件尾: 字段数 -1
+PGCOPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+PGCOPY_TRAILER = struct.pack("!h", -1)
+
+# 预编译的定长打包器: 长度前缀、int4/int8 字段 (含 4 字节长度)
+_LENGTH = struct.Struct("!i")
+_INT4_FIELD = struct.Struct("!ii")
+_INT8_FIELD = struct.Struct("!iq")
+_FIELD_COUNT = struct.pack("!h", 4)
+_NULL_FIELD = _LENGTH.pack(-1)
+# 输出端攒满该大小后再写文件
+_WRITE_BUFFER_SIZE = 1 << 20
+_PG_EPOCH = datetime(2000, 1, 1)
+_PG_EPOCH_UTC = datetime(2000, 1, 1, tzinfo=timezone.utc)
+# COPY text 格式的反斜杠转义: 单字符转义、\xH(H) 十六进制与 \N(NN) 八进制字节，其余字符按字面取
+_TEXT_ESCAPES = {b"b": b"\b", b"f": b"\f", b"n": b"\n", b"r": b"\r", b"t": b"\t", b"v": b"\v"}
+_ESCAPE_RE = re.compile(rb"\\(x[0-9A-Fa-f]{1,2}|[0-7]{1,3}|.)", re.DOTALL)
+# 含反斜杠的行按转义规则切分字段 (\| 是字段内容而非分隔符)
+_ESCAPED_FIELD_RE = re.compile(r"(?:[^|\\]|\\.)*", re.DOTALL)
+# 单独一行的 \. 是 COPY text 的数据结束标记
+_END_OF_DATA = "\\."
+
+
+def _unescape_match(m):
+    seq = m.group(1)
+    if seq[0] == 0x78 and len(seq) > 1:  # \xHH
+        return bytes((int(seq[1:], 16),))
+    if 0x30 <= seq[0] <= 0x37:  # \NNN，与服务端一致只取低 8 位
+        return bytes((int(seq, 8) & 0xFF,))
+    return _TEXT_ESCAPES.get(seq, seq)
+
+
+def _unescape(value):
+    """还原 COPY text 转义；八进制 / 十六进制字节可能拼出非法 UTF-8，服务端同样会拒绝"""
+    try:
+        return _ESCAPE_RE.sub(_unescape_match, value.encode("utf-8")).decode("utf-8")
+    except UnicodeDecodeError:
+        raise ValueError(f"转义还原后不是合法的 UTF-8: {value[:32]}")
+
+
+def _split_fields(line):
+    """按 COPY text 规则以 | 切分一行并还原各字段的转义；不含反斜杠的行直接 split"""
+    if "\\" not in line:
+        return line.split("|")
+    fields, pos = [], 0
+    while True:
+        m = _ESCAPED_FIELD_RE.match(line, pos)
+        fields.append(_unescape(m.group()))
+        pos = m.end()
+        if pos == len(line):
+            return fields
+        if line[pos] != "|":
+            raise ValueError("行尾存在未转义的反斜杠")
+        pos += 1
+
+
+def _encode_text(value):
+    data = value.encode("utf-8")
+    return _LENGTH.pack(len(data)) + data
+
+
+def _encode_geom(value):
+    """geometry 的二进制收发格式即 EWKB，输入须为 PostGIS 默认输出的十六进制 EWKB"""
+    try:
+        ewkb = bytes.fromhex(value)
+    except ValueError:
+        raise ValueError(f"geom 不是十六进制 EWKB: {value[:32]}...")
+    return _LENGTH.pack(len(ewkb)) + ewkb
+
+
+def _parse_timestamp(value):
+    # 兼容 Python < 3.11 的 fromisoformat: "Z" -> "+00:00"，"+08" -> "+08:00" (日期部分之后才可能出现时区)
+    if value[-1] == "Z":
+        value = value[:-1] + "+00:00"
+    elif len(value) > 10 and value[-3] in "+-":
+        value += ":00"
+    return datetime.fromisoformat(value)
+
+
+def _pack_micros(delta):
+    """timestamp / timestamptz 的二进制格式: 自 2000-01-01 起的微秒数 (int64)"""
+    return _INT8_FIELD.pack(8, (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds)
+
+
+def _encode_timestamp(value):
+    """timestamp (不带时区): 与文本 COPY 一致，忽略值中的时区，按字面时间存储"""
+    return _pack_micros(_parse_timestamp(value).replace(tzinfo=None) - _PG_EPOCH)
+
+
+def _timestamptz_encoder(tz=None):
+    """
+    timestamptz: 带时区的值换算为 UTC；不带时区的值文本 COPY 按会话 TimeZone 解释，
+    这里按 tz (应与导入会话一致) 解释，未指定 tz 时拒绝转换以免存入不同的时刻。
+    """
+    def encode(value):
+        dt = _parse_timestamp(value)
+        if dt.tzinfo is None:
+            if tz is None:
+                raise ValueError(f"timestamptz 的值缺少时区 (可用 --timezone 指定): {value}")
+            dt = dt.replace(tzinfo=tz)
+        return _pack_micros(dt - _PG_EPOCH_UTC)
+    return encode
+
+
+def _encode_int4(value):
+    return _INT4_FIELD.pack(4, int(value))
+
+
+def _encode_int8(value):
+    return _INT8_FIELD.pack(8, int(value))
+
+
+TAXI_ID_ENCODERS = {
+    "int4": _encode_int4,
+    "int8": _encode_int8,
+    "text": _encode_text,
+}
+
+
+DTG_TYPES = ("timestamp", "timestamptz")
+
+
+def encode_row(line, taxi_id_encoder=_encode_int4, dtg_encoder=_encode_timestamp):
+    """将一行 `fid|geom|dtg|taxi_id` 编码为一条 COPY BINARY 元组；空字段按 NULL 处理"""
+    fields = _split_fields(line)
+    if len(fields) != 4:
+        raise ValueError(f"期望 4 列，实际 {len(fields)} 列")
+    fid, geom, dtg, taxi_id = fields
+    # 列结构固定，逐列直接编码，避免逐行构造编码器序列
+    return b"".join((
+        _FIELD_COUNT,
+        _encode_text(fid) if fid else _NULL_FIELD,
+        _encode_geom(geom) if geom else _NULL_FIELD,
+        dtg_encoder(dtg) if dtg else _NULL_FIELD,
+        taxi_id_encoder(taxi_id) if taxi_id else _NULL_FIELD,
+    ))
+
+
+def convert_tbl_to_binary(src_path, dst_path=None, taxi_id_type="int4", dtg_type="timestamp", tz=None):
+    """
+    转换单个 .tbl 文件，返回 (目标路径, 行数)。
+    dtg_type 为目标表 dtg 列的类型；timestamptz 时不带时区的值按 tz 解释 (见 _timestamptz_encoder)。
+    """
+    src_path = Path(src_path)
+    dst_path = Path(dst_path) if dst_path else src_path.with_suffix(BINARY_SUFFIX)
+    taxi_id_encoder = TAXI_ID_ENCODERS[taxi_id_type]
+    dtg_encoder = _timestamptz_encoder(tz) if dtg_type == "timestamptz" else _encode_timestamp
+    rows = 0
+    # 先写同目录下的临时文件，成功后再原子替换，失败时不留下半截的 .bin
+    tmp_path = dst_path.with_name(dst_path.name + ".tmp")
+    try:
+        with open(src_path, "r", encoding="utf-8", newline="\n") as src, open(tmp_path, "wb") as dst:
+            out = bytearray(PGCOPY_HEADER)
+            for line_no, line in enumerate(src, 1):
+                line = line.rstrip("\r\n")
+                if not line: continue
+                if line == _END_OF_DATA: break
+                try:
+                    out += encode_row(line, taxi_id_encoder, dtg_encoder)
+                except (ValueError, struct.error, OverflowError) as e:
+                    # 越界的整数 (struct.error) 和时间戳 (OverflowError) 同样带上文件与行号
+                    raise ValueError(f"{src_path.name}:{line_no}: {e}") from e
+                rows += 1
+                if len(out) >= _WRITE_BUFFER_SIZE:
+                    dst.write(out)
+                    out.clear()
+            out += PGCOPY_TRAILER
+            dst.write(out)
+        os.replace(tmp_path, dst_path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    return dst_path, rows
+
+
+@click.command()
+@click.option('-d', '--directory', required=True,
+              type=click.Path(exists=True, file_okay=False, path_type=Path, resolve_path=True),
+              help="数据目录")
+@click.option('--taxi-id-type', type=click.Choice(sorted(TAXI_ID_ENCODERS)), default="int4",
+              help="taxi_id 列在目标表中的类型")
+@click.option('--dtg-type', type=click.Choice(DTG_TYPES), default="timestamp",
+              help="dtg 列在目标表中的类型")
+@click.option('--timezone', default=None,
+              help="dtg-type 为 timestamptz 时，不带时区的值按该时区解释 (应与导入会话的 TimeZone 一致)")
+def cli_text2bin(directory, taxi_id_type, dtg_type, timezone):
+    """将目录下的 .tbl 文件转换为同名 .bin (COPY BINARY) 文件"""
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s",
+                        datefmt="%Y-%m-%d %H:%M:%S")
+    try:
+        tz = ZoneInfo(timezone) if timezone else None
+    except (ValueError, ZoneInfoNotFoundError):
+        raise click.BadParameter(f"未知时区: {timezone}", param_hint="--timezone")
+    tbl_files = sorted(directory.glob("*.tbl"))
+    if not tbl_files:
+        logging.error("未找到 .tbl 文件。")
+        raise SystemExit(1)
+    for i, fpath in enumerate(tbl_files, 1):
+        try:
+            dst_path, rows = convert_tbl_to_binary(fpath, taxi_id_type=taxi_id_type, dtg_type=dtg_type, tz=tz)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        logging.info("  -> (%s/%s) %s -> %s (%s 行)", i, len(tbl_files), fpath.name, dst_path.name, rows)
@@ -2,36 +2,142 @@ import os
 import sys
 import time
 import logging
+import logging.handlers
+import atexit
+import queue
+import functools
+from dataclasses import dataclass
 from pathlib import Path
 from dotenv import load_dotenv
 
-load_dotenv()
+LOG_DIR = Path("logs")
+
 
 # ==================== 配置获取 ====================
-DB_USER = os.getenv("PG_USER", "postgres")
-DB_NAME = os.getenv("PG_DB", "postgres")
+@dataclass(frozen=True)
+class Settings:
+    """进程启动时的一次性环境快照，下游模块只读属性"""
+    db_user: str
+    db_name: str
+    pg_host: str
+    pg_port: str
+    db_password: str
+    cron_schedule_roll_wa: str
+    cron_schedule_maintenance: str
+    partition_cache_ttl: int
+    index_restore_parallel: int
+    index_maintenance_work_mem: str
+    index_maintenance_workers: str
+    row_bytes_estimate: int
+    index_keep_ratio: float
+    unsafe_async_commit: bool
+    copy_wal_compression: str
+    pg_session_settings: str
+    copy_lock_mode: str
+    copy_files_per_commit: int
+    copy_chunk_kb: int
+
+
+@functools.lru_cache(maxsize=None)
+def load_settings():
+    load_dotenv()
+    return Settings(
+        db_user=os.getenv("PG_USER", "postgres"),
+        db_name=os.getenv("PG_DB", "postgres"),
+        pg_host=os.getenv("PG_HOST", "localhost"),
+        pg_port=os.getenv("PG_PORT", "5432"),
+        db_password=os.getenv("PG_PASSWORD", ""),
+        # Cron 调度配置
+        cron_schedule_roll_wa=os.getenv("CRON_SCHEDULE_ROLL_WA", ""),
+        cron_schedule_maintenance=os.getenv("CRON_SCHEDULE_MAINTENANCE", ""),
+        # 分区名缓存有效期 (秒)，0 表示每个文件都重新查询 geomesa_wa_seq
+        partition_cache_ttl=int(os.getenv("PARTITION_CACHE_TTL", "30")),
+        # 索引恢复配置: 并行重建的连接数，以及每个连接的维护参数 (为空则沿用服务端默认值)
+        index_restore_parallel=int(os.getenv("INDEX_RESTORE_PARALLEL", "2")),
+        index_maintenance_work_mem=os.getenv("INDEX_MAINTENANCE_WORK_MEM", ""),
+        index_maintenance_workers=os.getenv("INDEX_MAINTENANCE_WORKERS", ""),
+        # 索引删除判定: 按平均行字节数估算文件行数，分区现有行数超过其 N 倍时保留索引直接导入
+        row_bytes_estimate=int(os.getenv("ROW_BYTES_ESTIMATE", "100")),
+        index_keep_ratio=float(os.getenv("INDEX_KEEP_RATIO", "10")),
+        # COPY 事务不等待 WAL 刷盘即返回 (崩溃时最多丢失最近已提交的批次，需重新导入)
+        unsafe_async_commit=os.getenv("UNSAFE_ASYNC_COMMIT", "0").lower() in ("1", "true", "yes", "on"),
+        # COPY 事务内的 wal_compression 取值 (需超级用户或已授予 SET 权限)，为空则不设置
+        copy_wal_compression=os.getenv("COPY_WAL_COMPRESSION", ""),
+        # 连接建立时设置的会话参数，格式 "name=value,name=value"
+        pg_session_settings=os.getenv("PG_SESSION_SETTINGS", "jit=off"),
+        # COPY 前对 {table}_wa 父表加的锁 (阻止 roll-wa 导入期间切换分区)，NONE 表示不加锁
+        copy_lock_mode=" ".join(os.getenv("COPY_LOCK_MODE", "SHARE").upper().split()),
+        # 每个事务提交的文件数: 大于 1 时同组文件共用一个事务、各自一个 SAVEPOINT，减少提交时的 WAL 刷盘
+        copy_files_per_commit=int(os.getenv("COPY_FILES_PER_COMMIT", "1")),
+        # COPY 时每次从文件读取并写入连接的块大小 (KiB)
+        copy_chunk_kb=int(os.getenv("COPY_CHUNK_KB", "1024")),
+    )
+
+
+settings = load_settings()
+
+DB_USER = settings.db_user
+DB_NAME = settings.db_name
+PG_HOST = settings.pg_host
+PG_PORT = settings.pg_port
+DB_PASSWORD = settings.db_password
 
-# 新增 Host 和 Port 配置
-PG_HOST = os.getenv("PG_HOST", "localhost")
-PG_PORT = os.getenv("PG_PORT", "5432")
-DB_PASSWORD = os.getenv("PG_PASSWORD", "")
-CONTAINER_NAME = os.getenv("PG_CONTAINER_NAME", "")  # 默认为空字符串
+# libpq 连接参数 (密码为空时交给 libpq 读取 .pgpass / PGPASSWORD)
+PG_CONNINFO = {
+    "host": PG_HOST,
+    "port": PG_PORT,
+    "user": DB_USER,
+    "dbname": DB_NAME,
+}
+if DB_PASSWORD:
+    PG_CONNINFO["password"] = DB_PASSWORD
 
-# Cron 调度配置
-CRON_SCHEDULE_ROLL_WA = os.getenv("CRON_SCHEDULE_ROLL_WA", "")
-CRON_SCHEDULE_MAINTENANCE = os.getenv("CRON_SCHEDULE_MAINTENANCE", "")
+CRON_SCHEDULE_ROLL_WA = settings.cron_schedule_roll_wa
+CRON_SCHEDULE_MAINTENANCE = settings.cron_schedule_maintenance
+PARTITION_CACHE_TTL = settings.partition_cache_ttl
+INDEX_RESTORE_PARALLEL = settings.index_restore_parallel
+INDEX_MAINTENANCE_WORK_MEM = settings.index_maintenance_work_mem
+INDEX_MAINTENANCE_WORKERS = settings.index_maintenance_workers
+ROW_BYTES_ESTIMATE = settings.row_bytes_estimate
+INDEX_KEEP_RATIO = settings.index_keep_ratio
+UNSAFE_ASYNC_COMMIT = settings.unsafe_async_commit
+COPY_WAL_COMPRESSION = settings.copy_wal_compression
+# SHARE 与自身兼容 (并行 COPY 互不阻塞)，且与 roll-wa 所需的 SHARE UPDATE EXCLUSIVE 及以上锁冲突
+_COPY_LOCK_MODES = ("ACCESS SHARE", "ROW SHARE", "ROW EXCLUSIVE", "SHARE UPDATE EXCLUSIVE", "SHARE",
+                    "SHARE ROW EXCLUSIVE", "EXCLUSIVE", "ACCESS EXCLUSIVE", "NONE")
+if settings.copy_lock_mode not in _COPY_LOCK_MODES:
+    raise ValueError(f"COPY_LOCK_MODE 无效: {settings.copy_lock_mode}，可选 {', '.join(_COPY_LOCK_MODES)}")
+COPY_LOCK_MODE = "" if settings.copy_lock_mode == "NONE" else settings.copy_lock_mode
+COPY_FILES_PER_COMMIT = max(settings.copy_files_per_commit, 1)
+# 按 4 KiB 页对齐，至少一页
+COPY_CHUNK_SIZE = max(settings.copy_chunk_kb // 4, 1) * 4096
+# 解析为 [(name, value), ...]，忽略空项
+PG_SESSION_SETTINGS = [tuple(part.strip() for part in item.split("=", 1))
+                       for item in settings.pg_session_settings.split(",") if "=" in item]
 
 
 def setup_logging():
-    log_dir = Path("logs")
-    log_dir.mkdir(exist_ok=True)
-    log_file = log_dir / f"import_log_{time.strftime('%Y%m%d')}.log"
-    logging.basicConfig(
-        level=logging.INFO,
-        format="%(asctime)s - %(levelname)s - %(message)s",
-        datefmt="%Y-%m-%d %H:%M:%S",
-        handlers=[logging.FileHandler(log_file, encoding="utf-8"), logging.StreamHandler(sys.stdout)]
+    # 目录通常已存在，先 stat 判断，省去一次 mkdir 系统调用
+    if not LOG_DIR.is_dir(): LOG_DIR.mkdir(exist_ok=True)
+    log_file = LOG_DIR / f"import_log_{time.strftime('%Y%m%d')}.log"
+    formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
+    # 文件日志先在内存中攒批，满 1024 条或出现 WARNING 及以上级别时再落盘；首次落盘时才打开文件
+    file_handler = logging.FileHandler(log_file, encoding="utf-8", delay=True)
+    file_handler.setFormatter(formatter)
+    memory_handler = logging.handlers.MemoryHandler(
+        capacity=1024, flushLevel=logging.WARNING, target=file_handler, flushOnClose=True
     )
+    atexit.register(memory_handler.flush)
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(formatter)
+    # 业务线程只做 queue.put，文件与控制台写入由后台监听线程完成
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.setFormatter(logging.Formatter("%(message)s"))
+    listener = logging.handlers.QueueListener(log_queue, memory_handler, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
 
 # ==================== 新增: SwanLab 环境配置字典 ====================
 # 专门用于传递给 swanlab.init(config=...)
@@ -41,7 +147,18 @@ SWANLAB_ENV_SETTINGS = {
     "Env/PG_DB": DB_NAME,
     "Env/PG_HOST": PG_HOST,
     "Env/PG_PORT": PG_PORT,
-    "Env/CONTAINER_NAME": CONTAINER_NAME,
     "Env/CRON_ROLL_WA": CRON_SCHEDULE_ROLL_WA,
     "Env/CRON_MAINTENANCE": CRON_SCHEDULE_MAINTENANCE,
+    "Env/PARTITION_CACHE_TTL": PARTITION_CACHE_TTL,
+    "Env/INDEX_RESTORE_PARALLEL": INDEX_RESTORE_PARALLEL,
+    "Env/INDEX_MAINTENANCE_WORK_MEM": INDEX_MAINTENANCE_WORK_MEM,
+    "Env/INDEX_MAINTENANCE_WORKERS": INDEX_MAINTENANCE_WORKERS,
+    "Env/ROW_BYTES_ESTIMATE": ROW_BYTES_ESTIMATE,
+    "Env/INDEX_KEEP_RATIO": INDEX_KEEP_RATIO,
+    "Env/UNSAFE_ASYNC_COMMIT": UNSAFE_ASYNC_COMMIT,
+    "Env/COPY_WAL_COMPRESSION": COPY_WAL_COMPRESSION,
+    "Env/PG_SESSION_SETTINGS": settings.pg_session_settings,
+    "Env/COPY_LOCK_MODE": settings.copy_lock_mode,
+    "Env/COPY_FILES_PER_COMMIT": COPY_FILES_PER_COMMIT,
+    "Env/COPY_CHUNK_KB": settings.copy_chunk_kb,
 }
\ No newline at end of file
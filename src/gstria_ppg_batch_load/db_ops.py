@@ -1,79 +1,245 @@
 import time
 import logging
-from .utils import run_sql_command
-from .config import CRON_SCHEDULE_ROLL_WA, CRON_SCHEDULE_MAINTENANCE
+import threading
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor
+from psycopg import sql
+from .utils import get_pool, run_sql_command, set_local_settings
+from .config import (CRON_SCHEDULE_ROLL_WA, CRON_SCHEDULE_MAINTENANCE, PARTITION_CACHE_TTL,
+                     INDEX_RESTORE_PARALLEL, INDEX_MAINTENANCE_WORK_MEM, INDEX_MAINTENANCE_WORKERS,
+                     ROW_BYTES_ESTIMATE, INDEX_KEEP_RATIO)
 
+# 分区名缓存: {table_base_name: (pure_name, expires_at)}，缓存不带引号的表名
+_PARTITION_CACHE = {}
+_PARTITION_CACHE_LOCK = threading.Lock()
+
+# 辅助索引定义缓存: {pure_name: [(index_name, index_def), ...]}
+# 在同一批次内分区的索引结构不变，只需首次查询 pg_index
+_INDEX_DEF_CACHE = {}
+# 主键定义缓存: {pure_name: (pk_name, pk_def) | None}
+_PKEY_DEF_CACHE = {}
+
+# SQL 模板: 值一律走 %s 参数；DDL 中的标识符无法参数化，用 psycopg.sql.Identifier 由客户端转义后填充
+# 分区元数据，每行格式: (标签, 名称, 定义)，P=分区 I=辅助索引 K=主键
+_PREPARE_SQL = ("WITH p AS (SELECT type_name || '_wa_' || lpad(value::text, 3, '0') AS relname "
+                "FROM \"public\".\"geomesa_wa_seq\" WHERE type_name = %s), "
+                "t AS (SELECT c.oid FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+                "JOIN p ON p.relname = c.relname WHERE n.nspname = 'public') "
+                "SELECT 'P', relname, '' FROM p "
+                "UNION ALL SELECT 'I', i.relname, pg_get_indexdef(ix.indexrelid) FROM t "
+                "JOIN pg_index ix ON ix.indrelid = t.oid JOIN pg_class i ON i.oid = ix.indexrelid "
+                "WHERE ix.indisprimary = 'f' "
+                "UNION ALL SELECT 'K', c.conname, pg_get_constraintdef(c.oid) FROM t "
+                "JOIN pg_constraint c ON c.conrelid = t.oid WHERE c.contype = 'p'")
+_RELTUPLES_SQL = ("SELECT reltuples::bigint FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+                  "WHERE c.relname = %s AND n.nspname = 'public'")
+_CRON_SCHEDULE_SQL = "UPDATE cron.job SET schedule = %s WHERE jobname = %s"
+# 视图 {table} 背后实际存放数据的表 (写前日志及其子分区、分区表、溢出表)，不存在的返回 NULL 被过滤
+_BACKING_TABLES_SQL = ("SELECT s.name FROM unnest(ARRAY[%s || '_wa', %s || '_wa_partition', "
+                       "%s || '_partition', %s || '_spill']) AS s(name) "
+                       "WHERE to_regclass(quote_ident('public') || '.' || quote_ident(s.name)) IS NOT NULL")
+# 背后数据表及其继承子表的 reltuples 之和 (从未 ANALYZE 的表为 -1，按 0 计)
+_ROW_ESTIMATE_SQL = ("WITH t AS (SELECT to_regclass(quote_ident('public') || '.' || quote_ident(s.name)) AS oid "
+                     "FROM unnest(ARRAY[%s || '_wa', %s || '_wa_partition', %s || '_partition', %s || '_spill']) "
+                     "AS s(name)) "
+                     "SELECT coalesce(sum(greatest(c.reltuples, 0)), 0)::bigint FROM pg_class c "
+                     "WHERE c.oid IN (SELECT oid FROM t) "
+                     "OR c.oid IN (SELECT i.inhrelid FROM pg_inherits i JOIN t ON i.inhparent = t.oid)")
+_DROP_INDEX_SQL = sql.SQL("DROP INDEX IF EXISTS {}")
+# 最后一个占位符为服务端 pg_get_constraintdef 返回的约束定义
+_RESET_PK_SQL = sql.SQL("ALTER TABLE {} DROP CONSTRAINT IF EXISTS {}, ADD CONSTRAINT {} {}")
+# 只需探测一行，与分区大小无关
+_IS_EMPTY_SQL = sql.SQL("SELECT NOT EXISTS (SELECT 1 FROM ONLY {})")
+_SET_LOGGED_SQL = sql.SQL("ALTER TABLE {} SET {}")
+_TRUNCATE_SQL = sql.SQL("TRUNCATE {} RESTART IDENTITY")
+_COUNT_SQL = sql.SQL("SELECT count(1) FROM {}")
+
+
+@dataclass
+class PartitionPlan:
+    """一次导入所需的分区元数据"""
+    pure_name: str  # 不带引号的分区表名，如 t_wa_003
+    index_defs: list = field(default_factory=list)  # [(index_name, index_def), ...]
+    pk_def: tuple = None  # (pk_name, pk_def)，无主键时为 None
+
+    @property
+    def identifier(self):
+        """public.{pure_name} 的 sql.Identifier，用于组合 DDL"""
+        return sql.Identifier("public", self.pure_name)
+
+
+def prepare_partition(table_base_name, reset_pk=False):
+    """
+    经连接池一次查询取齐分区名、辅助索引与主键定义。
+    三者均已缓存时不访问数据库。
+    """
+    now = time.monotonic()
+    with _PARTITION_CACHE_LOCK:
+        cached = _PARTITION_CACHE.get(table_base_name)
+    if cached and cached[1] > now:
+        pure_name = cached[0]
+        if pure_name in _INDEX_DEF_CACHE and (not reset_pk or pure_name in _PKEY_DEF_CACHE):
+            return PartitionPlan(pure_name, _INDEX_DEF_CACHE[pure_name], _PKEY_DEF_CACHE.get(pure_name))
 
-def get_partition_name(table_base_name):
-    sql = (f"SELECT '\"{table_base_name}_wa_' || lpad(value::text, 3, '0') || '\"' "
-           f"FROM \"public\".\"geomesa_wa_seq\" WHERE type_name = '{table_base_name}'")
     try:
-        res = run_sql_command(sql, fetch_output=True)
-        if not res.stdout.strip(): raise ValueError("Empty partition name")
-        logging.info(f"      -> 分区表: {res.stdout.strip()}")
-        return res.stdout.strip()
+        pure_name, index_defs, pk_def = None, [], None
+        for tag, name, definition in run_sql_command(_PREPARE_SQL, fetch_output=True,
+                                                     params=(table_base_name,)):
+            if tag == 'P':
+                pure_name = name
+            elif tag == 'I':
+                index_defs.append((name, definition))
+            elif tag == 'K':
+                pk_def = (name, definition)
+        if not pure_name: raise ValueError("Empty partition name")
+        logging.info("      -> 分区表: \"%s\"", pure_name)
     except Exception as e:
-        logging.error(f"      -> Get Partition Failed: {e}")
+        logging.error("      -> Get Partition Failed: %s", e)
         raise e
 
+    with _PARTITION_CACHE_LOCK:
+        _PARTITION_CACHE[table_base_name] = (pure_name, now + PARTITION_CACHE_TTL)
+    _INDEX_DEF_CACHE[pure_name] = index_defs
+    _PKEY_DEF_CACHE[pure_name] = pk_def
+    return PartitionPlan(pure_name, index_defs, pk_def)
 
-def backup_and_drop_indexes(partition_name_quoted):
-    pure_name = partition_name_quoted.replace('"', '')
-    logging.info(f"      [Index Backup] 分析 {partition_name_quoted} 辅助索引...")
-    sql = (f"SELECT i.relname, pg_get_indexdef(ix.indexrelid) FROM pg_index ix "
-           f"JOIN pg_class t ON t.oid = ix.indrelid JOIN pg_class i ON i.oid = ix.indexrelid "
-           f"JOIN pg_namespace n ON n.oid = t.relnamespace WHERE t.relname = '{pure_name}' "
-           f"AND n.nspname = 'public' AND ix.indisprimary = 'f';")
-    restore_sqls = []
+
+def should_drop_indexes(plan, incoming_size_bytes):
+    """
+    判断本次导入是否值得删除再重建辅助索引。
+    分区现有行数 (pg_class.reltuples 估算) 远大于本次导入行数时，重建全部索引的代价
+    高于 COPY 时顺带维护索引，此时保留索引。
+    """
+    if not plan.index_defs: return False
+    incoming_rows = incoming_size_bytes // max(ROW_BYTES_ESTIMATE, 1)
     try:
-        res = run_sql_command(sql, fetch_output=True)
-        lines = [l for l in res.stdout.strip().split('\n') if l]
-        if not lines:
-            logging.info("      -> 无辅助索引。")
-            return []
-        for line in lines:
-            parts = line.split('|', 1)
-            if len(parts) < 2: continue
-            restore_sqls.append(f"{parts[1]};")
-            run_sql_command(f"DROP INDEX IF EXISTS \"public\".\"{parts[0]}\";")
-        logging.info(f"      -> 删除 {len(restore_sqls)} 个辅助索引。")
+        rows = run_sql_command(_RELTUPLES_SQL, fetch_output=True, params=(plan.pure_name,))
+        # 从未 ANALYZE 的表 reltuples 为 -1，按空表处理
+        existing_rows = max(rows[0][0], 0) if rows else 0
+    except Exception as e:
+        logging.warning("      -> 读取 reltuples 失败，按默认策略删除索引: %s", e)
+        return True
+    drop = existing_rows <= incoming_rows * INDEX_KEEP_RATIO
+    logging.info("      -> 现有约 %s 行 / 导入约 %s 行: %s", existing_rows, incoming_rows,
+                 '删除并重建辅助索引' if drop else '保留辅助索引')
+    return drop
+
+
+def backup_and_drop_indexes(plan):
+    logging.info("      [Index Backup] 分析 %s 辅助索引...", plan.pure_name)
+    if not plan.index_defs:
+        logging.info("      -> 无辅助索引。")
+        return []
+    try:
+        restore_sqls = [f"{index_def};" for _, index_def in plan.index_defs]
+        drop_stmts = [_DROP_INDEX_SQL.format(sql.Identifier("public", index_name))
+                      for index_name, _ in plan.index_defs]
+        run_sql_command(sql.SQL(";\n").join(drop_stmts))
+        logging.info("      -> 删除 %s 个辅助索引。", len(restore_sqls))
         return restore_sqls
     except Exception as e:
-        logging.error(f"      -> Index Ops Failed: {e}")
+        logging.error("      -> Index Ops Failed: %s", e)
         raise e
 
 
-def reset_primary_key(partition_name_quoted):
+def reset_primary_key(plan):
     """Step 1.6: 仅在 Collatec 模式下调用"""
-    pure_name = partition_name_quoted.replace('"', '')
-    logging.info(f"      [PKey Reset] 重置 {partition_name_quoted} 主键...")
-    sql = (f"SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
-           f"WHERE conrelid = 'public.{pure_name}'::regclass AND contype = 'p';")
+    logging.info("      [PKey Reset] 重置 %s 主键...", plan.pure_name)
+    if not plan.pk_def: return
+    pk_name, pk_def = plan.pk_def
     try:
-        res = run_sql_command(sql, fetch_output=True)
-        if not res.stdout.strip(): return
-        parts = res.stdout.strip().split('|', 1)
-        if len(parts) < 2: return
-        pk_name, pk_def = parts[0], parts[1]
-        run_sql_command(f"ALTER TABLE \"public\".\"{pure_name}\" DROP CONSTRAINT IF EXISTS \"{pk_name}\";")
-        t0 = time.time()
-        run_sql_command(f"ALTER TABLE \"public\".\"{pure_name}\" ADD CONSTRAINT \"{pk_name}\" {pk_def};")
-        logging.info(f"      -> 主键重建完成 (耗时: {time.time() - t0:.2f}s)。")
+        # 空分区没有需要重建的主键索引数据，DROP + ADD 只是白白多一次 DDL
+        rows = run_sql_command(_IS_EMPTY_SQL.format(plan.identifier), fetch_output=True)
+        if rows and rows[0][0]:
+            logging.info("      -> 分区为空，跳过主键重置。")
+            return
+        t0 = time.monotonic()
+        # DROP 与 ADD 合并为同一条 ALTER TABLE，一次往返完成重建
+        pk_ident = sql.Identifier(pk_name)
+        # 重建主键同样是一次索引构建，沿用恢复索引时的 maintenance_work_mem / 并行 worker 设置
+        _run_index_build(_RESET_PK_SQL.format(plan.identifier, pk_ident, pk_ident, sql.SQL(pk_def)))
+        logging.info("      -> 主键重建完成 (耗时: %.2fs)。", time.monotonic() - t0)
     except Exception as e:
-        logging.error(f"      -> PKey Reset Failed: {e}")
+        logging.error("      -> PKey Reset Failed: %s", e)
+        raise e
+
+
+def set_partition_logged(plan, logged):
+    """切换分区的 WAL 记录方式；两个方向都会重写整张表，应在批次首尾各调用一次"""
+    mode = "LOGGED" if logged else "UNLOGGED"
+    logging.info("      [WAL] %s SET %s...", plan.pure_name, mode)
+    try:
+        t0 = time.monotonic()
+        run_sql_command(_SET_LOGGED_SQL.format(plan.identifier, sql.SQL(mode)))
+        logging.info("      -> 完成 (耗时: %.2fs)。", time.monotonic() - t0)
+    except Exception as e:
+        logging.error("      -> SET %s Failed: %s", mode, e)
         raise e
 
 
 def restore_indexes(restore_sqls):
     if not restore_sqls: return
-    logging.info(f"      [Index Restore] 恢复 {len(restore_sqls)} 个索引...")
+    workers = max(1, min(len(restore_sqls), INDEX_RESTORE_PARALLEL))
+    logging.info("      [Index Restore] 恢复 %s 个索引 (并行度: %s)...", len(restore_sqls), workers)
     try:
-        for sql in restore_sqls: run_sql_command(sql)
+        if workers == 1:
+            _run_index_build("\n".join(restore_sqls))
+            return
+        # 每个 CREATE INDEX 占用连接池中的独立连接，互不相关的索引可同时构建
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_run_index_build, stmt) for stmt in restore_sqls]
+            for future in futures: future.result()
     except Exception as e:
-        logging.error(f"      -> Restore Failed: {e}")
+        logging.error("      -> Restore Failed: %s", e)
         raise e
 
 
+def _index_maintenance_settings():
+    settings = []
+    if INDEX_MAINTENANCE_WORK_MEM:
+        settings.append(("maintenance_work_mem", INDEX_MAINTENANCE_WORK_MEM))
+    if INDEX_MAINTENANCE_WORKERS:
+        settings.append(("max_parallel_maintenance_workers", str(int(INDEX_MAINTENANCE_WORKERS))))
+    return settings
+
+
+def _run_index_build(stmt):
+    """在同一事务内先设置维护参数 (见 _index_maintenance_settings)，再执行索引构建语句"""
+    with get_pool().connection() as conn:
+        set_local_settings(conn, _index_maintenance_settings())
+        conn.execute(stmt)
+
+
+def clear_table(table_base_name, cascade=False):
+    """
+    清空目标表。{table} 是 GeoMesa 创建的视图，无法直接 TRUNCATE:
+    对其背后的数据表执行 TRUNCATE (继承的子分区一并清空)，找不到数据表或 TRUNCATE 失败时退回 DELETE。
+    cascade=True 时同时清空通过外键引用这些表的其他表。
+    """
+    try:
+        rows = run_sql_command(_BACKING_TABLES_SQL, fetch_output=True, params=(table_base_name,) * 4)
+        if rows:
+            stmt = _TRUNCATE_SQL.format(sql.SQL(", ").join(sql.Identifier("public", name) for (name,) in rows))
+            run_sql_command(stmt + sql.SQL(" CASCADE") if cascade else stmt)
+            logging.info("   -> TRUNCATE %s", ', '.join(name for (name,) in rows))
+            return
+    except Exception as e:
+        logging.warning("   -> TRUNCATE 失败，改用 DELETE: %s", e)
+    run_sql_command(sql.SQL("DELETE FROM {}").format(sql.Identifier("public", table_base_name)))
+
+
+def estimate_row_count(table_base_name):
+    """按 pg_class.reltuples 估算视图 {table} 的总行数，免去全表 count 扫描 (精度取决于最近一次 ANALYZE / 建索引)"""
+    rows = run_sql_command(_ROW_ESTIMATE_SQL, fetch_output=True, params=(table_base_name,) * 4)
+    return rows[0][0] if rows else 0
+
+
+def count_rows(table_base_name):
+    """对视图 {table} 执行全表 count，返回精确行数"""
+    rows = run_sql_command(_COUNT_SQL.format(sql.Identifier("public", table_base_name)), fetch_output=True)
+    return rows[0][0] if rows else 0
+
+
 def update_cron_jobs(table_base_name):
     """
     根据 .env 配置更新 pg_cron 的调度时间
@@ -86,25 +252,21 @@ def update_cron_jobs(table_base_name):
     # 1. 更新 roll-wa 任务
     if CRON_SCHEDULE_ROLL_WA:
         job_name = f"{table_base_name}-roll-wa"
-        logging.info(f"   -> 更新 Cron Job '{job_name}' Schedule 为: {CRON_SCHEDULE_ROLL_WA}")
-        sql = (f"UPDATE cron.job SET schedule = '{CRON_SCHEDULE_ROLL_WA}' "
-               f"WHERE jobname = '{job_name}';")
+        logging.info("   -> 更新 Cron Job '%s' Schedule 为: %s", job_name, CRON_SCHEDULE_ROLL_WA)
         try:
-            run_sql_command(sql)
+            run_sql_command(_CRON_SCHEDULE_SQL, params=(CRON_SCHEDULE_ROLL_WA, job_name))
         except Exception as e:
-            logging.warning(f"   -> 更新失败 (可能缺少权限或表不存在): {e}")
+            logging.warning("   -> 更新失败 (可能缺少权限或表不存在): %s", e)
     else:
-        logging.info(f"   -> 跳过更新 {table_base_name}-roll-wa (配置为空)")
+        logging.info("   -> 跳过更新 %s-roll-wa (配置为空)", table_base_name)
 
     # 2. 更新 partition_maintenance 任务
     if CRON_SCHEDULE_MAINTENANCE:
         job_name = f"{table_base_name}_partition_maintenance"
-        logging.info(f"   -> 更新 Cron Job '{job_name}' Schedule 为: {CRON_SCHEDULE_MAINTENANCE}")
-        sql = (f"UPDATE cron.job SET schedule = '{CRON_SCHEDULE_MAINTENANCE}' "
-               f"WHERE jobname = '{job_name}';")
+        logging.info("   -> 更新 Cron Job '%s' Schedule 为: %s", job_name, CRON_SCHEDULE_MAINTENANCE)
         try:
-            run_sql_command(sql)
+            run_sql_command(_CRON_SCHEDULE_SQL, params=(CRON_SCHEDULE_MAINTENANCE, job_name))
         except Exception as e:
-            logging.warning(f"   -> 更新失败: {e}")
+            logging.warning("   -> 更新失败: %s", e)
     else:
-        logging.info(f"   -> 跳过更新 {table_base_name}_partition_maintenance (配置为空)")
+        logging.info("   -> 跳过更新 %s_partition_maintenance (配置为空)", table_base_name)
@@ -1,117 +1,520 @@
+import os
 import subprocess
-import shlex
+import tempfile
+import contextlib
 import logging
 import time
-from .utils import run_command, build_psql_prefix
-from .db_ops import get_partition_name, backup_and_drop_indexes, reset_primary_key, restore_indexes
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from psycopg import sql
+from .utils import get_pool, run_sql_command
+from .binary_copy import BINARY_SUFFIX
+from .config import (UNSAFE_ASYNC_COMMIT, COPY_WAL_COMPRESSION, COPY_LOCK_MODE, COPY_FILES_PER_COMMIT,
+                     COPY_CHUNK_SIZE)
+from .db_ops import prepare_partition, should_drop_indexes, backup_and_drop_indexes, reset_primary_key, restore_indexes
 
+# .bin 文件为 COPY BINARY 格式 (见 binary_copy.py)，其余按 | 分隔的文本格式导入
+COPY_TEXT_OPTIONS = "FORMAT text, DELIMITER E'|', NULL E''"
+COPY_BINARY_OPTIONS = "FORMAT binary"
 
-def import_single_file_with_lock(file_path, table_base_name, enable_pk_reset=False):
+# 并行导入时同一分区的索引只删一次、恢复一次: {pure_name: [refcount, restore_sqls]}
+_PARTITION_USERS = {}
+_PARTITION_USERS_LOCK = threading.Lock()
+
+# 暂存模式下各文件先 COPY 进 UNLOGGED 暂存表 (不写 WAL)，全部完成后一次 INSERT ... SELECT 写入分区
+_STAGE_TABLE = "_stage_{}"
+_COPY_COLUMNS = sql.SQL(", ").join(map(sql.Identifier, ("fid", "geom", "dtg", "taxi_id")))
+_COPY_SQL = sql.SQL("COPY {} ({}) FROM STDIN WITH ({})")
+_LOCK_SQL = sql.SQL("LOCK TABLE ONLY {} IN {} MODE")
+_SET_LOCAL_SQL = sql.SQL("set_config({}, {}, true)")
+_CREATE_STAGE_SQL = sql.SQL("DROP TABLE IF EXISTS {0};\nCREATE UNLOGGED TABLE {0} (LIKE {1} INCLUDING DEFAULTS)")
+_FLUSH_STAGE_SQL = sql.SQL("INSERT INTO {} ({}) SELECT {} FROM {}")
+# 暂存表不存在时 to_regclass 为 NULL，按 0 字节处理
+_STAGE_SIZE_SQL = ("SELECT coalesce(pg_relation_size("
+                   "to_regclass(quote_ident('public') || '.' || quote_ident(%s))), 0)")
+
+# 索引策略: auto 按分区现有行数与导入量判定 (见 should_drop_indexes)，另两种强制删除 / 保留
+INDEX_STRATEGIES = ("auto", "always-drop", "never-drop")
+
+
+def _fadvise(fd, advice):
+    """向内核声明文件访问模式；posix_fadvise 不可用的平台 (如 macOS / Windows) 静默跳过"""
+    if not hasattr(os, "posix_fadvise"): return
+    try:
+        os.posix_fadvise(fd, 0, 0, getattr(os, advice))
+    except OSError:
+        pass
+
+
+def _prefetch(file_path):
+    """提示内核提前预读整个文件 (WILLNEED 只发起异步预读，立即返回)"""
+    try:
+        fd = os.open(file_path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        _fadvise(fd, "POSIX_FADV_WILLNEED")
+    finally:
+        os.close(fd)
+
+
+@contextlib.contextmanager
+def _presorted(file_path, enabled=True):
     """
-    修改后：返回 (CompletedProcess, metrics_dict)
+    enabled 时用 GNU sort 将文本文件按主键前缀 (fid, dtg) 字节序排序到临时文件，产出该临时文件路径，
+    退出时删除。有序输入使 COPY 维护主键 B-tree 时近似顺序追加；排序失败则退回原文件。
     """
+    if not enabled:
+        yield file_path
+        return
+    # 排序结果与 sort 的中间文件都放在源文件所在目录，不占用可能很小的 /tmp；
+    # 后缀不以 .tbl 结尾，避免被并发运行的目录扫描当作数据文件
+    work_dir = str(Path(file_path).parent)
+    fd, sorted_path = tempfile.mkstemp(prefix=".presort_", suffix=Path(file_path).suffix + ".tmp", dir=work_dir)
+    os.close(fd)
+    try:
+        subprocess.run(["sort", "-t", "|", "-k1,1", "-k3,3", "-T", work_dir, "-o", sorted_path, str(file_path)],
+                       check=True, capture_output=True, env={**os.environ, "LC_ALL": "C"})
+    except (OSError, subprocess.CalledProcessError) as e:
+        os.unlink(sorted_path)
+        detail = e.stderr.decode(errors="replace").strip() if getattr(e, "stderr", None) else e
+        logging.warning("      -> 预排序失败，按原顺序导入: %s", detail)
+        yield file_path
+        return
+    try:
+        yield sorted_path
+    finally:
+        os.unlink(sorted_path)
+
 
-    # 初始化指标字典
-    metrics = {
+def _begin_copy(conn, lock_sql=None):
+    """
+    COPY 事务开头: 事务级参数 (set_config(..., true)，事务结束后自动恢复) 与 lock_sql 加锁
+    拼成一条多语句 SQL 一次发送；都不需要时不发送任何语句。
+    """
+    settings = []
+    if UNSAFE_ASYNC_COMMIT:
+        settings.append(("synchronous_commit", "off"))
+    if COPY_WAL_COMPRESSION:
+        settings.append(("wal_compression", COPY_WAL_COMPRESSION))
+    stmts = []
+    if settings:
+        stmts.append(sql.SQL("SELECT ") + sql.SQL(", ").join(
+            _SET_LOCAL_SQL.format(sql.Literal(name), sql.Literal(value)) for name, value in settings))
+    if lock_sql is not None:
+        stmts.append(lock_sql)
+    # 多语句只能在无参数时发送，值已用 sql.Literal 内联
+    if stmts:
+        conn.execute(sql.SQL(";\n").join(stmts))
+
+
+def _lock_wa_sql(table_base_name):
+    """
+    导入事务内对写前日志父表加锁的语句 (锁模式见 COPY_LOCK_MODE)，不加锁时返回 None。
+    用 ONLY 只锁父表: 不带 ONLY 时锁会传递到子分区，SHARE 锁与 COPY 的 ROW EXCLUSIVE 冲突，并行导入会死锁；
+    子分区本身已由 COPY 的 ROW EXCLUSIVE 保护。
+    """
+    if not COPY_LOCK_MODE: return None
+    # COPY_LOCK_MODE 已在 config 中按合法锁模式校验
+    return _LOCK_SQL.format(sql.Identifier("public", f"{table_base_name}_wa"), sql.SQL(COPY_LOCK_MODE))
+
+
+def _copy_into(conn, file_path, target, freeze=False):
+    """在 conn 的当前事务中将文件 COPY 进 target (表的 sql.Identifier)，返回写入行数"""
+    copy_options = COPY_BINARY_OPTIONS if Path(file_path).suffix == BINARY_SUFFIX else COPY_TEXT_OPTIONS
+    if freeze:
+        copy_options += ", FREEZE"
+    copy_sql = _COPY_SQL.format(target, _COPY_COLUMNS, sql.SQL(copy_options))
+    # COPY 协议以 CopyDone 结束数据流，末行缺少换行符也能被正确解析，无需补 '\n'
+    cur = conn.cursor()
+    with cur.copy(copy_sql) as cp, open(file_path, 'rb', buffering=0) as f:
+        # 数据文件只顺序读一遍: 加大预读，读完后释放其页缓存，避免挤占数据库的缓存
+        _fadvise(f.fileno(), "POSIX_FADV_SEQUENTIAL")
+        _fadvise(f.fileno(), "POSIX_FADV_WILLNEED")
+        # 复用同一块缓冲区；psycopg 会把大块数据再切片发送，memoryview 切片不产生拷贝
+        buf = bytearray(COPY_CHUNK_SIZE)
+        view = memoryview(buf)
+        while n := f.readinto(buf):
+            cp.write(view[:n])
+        _fadvise(f.fileno(), "POSIX_FADV_DONTNEED")
+    # COPY 结束后服务端返回的 "COPY n" 即为行数，无需事后 count
+    return cur.rowcount
+
+
+def _copy_file(file_path, target, lock_sql=None):
+    """在独立事务中将文件 COPY 进 target，返回写入行数；lock_sql 非空时先执行该加锁语句"""
+    with get_pool().connection() as conn:
+        with conn.transaction():
+            _begin_copy(conn, lock_sql)
+            return _copy_into(conn, file_path, target)
+
+
+def _new_metrics(partition_name="N/A"):
+    """单个文件 (或一次写入分区) 的耗时与行数统计，各导入路径共用的初值"""
+    return {
         "time_drop_index": 0.0,
         "time_reset_pk": 0.0,
         "time_copy": 0.0,
         "time_restore_index": 0.0,
-        "partition_name": "N/A"  # 确保有默认值
+        "time_total": 0.0,
+        "rows_copied": 0,
+        "partition_name": partition_name,
     }
 
-    # --- 步骤 1: 获取动态分区表名 ---
+
+def _want_drop_indexes(plan, incoming_size_bytes, index_strategy):
+    if index_strategy == "never-drop":
+        return False
+    if index_strategy == "always-drop":
+        return bool(plan.index_defs)
+    return should_drop_indexes(plan, incoming_size_bytes)
+
+
+def _acquire_partition(plan, incoming_size_bytes, enable_pk_reset, metrics, index_strategy="auto"):
+    """首个进入分区的文件负责删除索引 (及重置主键)，后续文件直接复用"""
+    with _PARTITION_USERS_LOCK:
+        entry = _PARTITION_USERS.get(plan.pure_name)
+        if entry is not None:
+            entry[0] += 1
+            return
+        restore_sqls = []
+        _PARTITION_USERS[plan.pure_name] = [1, restore_sqls]
+
+        t_start = time.monotonic()
+        if _want_drop_indexes(plan, incoming_size_bytes, index_strategy):
+            restore_sqls.extend(backup_and_drop_indexes(plan))
+        metrics["time_drop_index"] = time.monotonic() - t_start
+
+        if enable_pk_reset:
+            t_start = time.monotonic()
+            reset_primary_key(plan)
+            metrics["time_reset_pk"] = time.monotonic() - t_start
+
+
+def _release_partition(plan, metrics):
+    """最后一个离开分区的文件负责恢复索引"""
+    with _PARTITION_USERS_LOCK:
+        entry = _PARTITION_USERS[plan.pure_name]
+        entry[0] -= 1
+        if entry[0] > 0:
+            return
+        del _PARTITION_USERS[plan.pure_name]
+        t_start = time.monotonic()
+        restore_indexes(entry[1])
+        metrics["time_restore_index"] = time.monotonic() - t_start
+
+
+def _hold_partition(plan, incoming_size_bytes, enable_pk_reset, metrics, index_strategy="auto"):
+    """
+    _acquire_partition 的安全包装: 引用计数在删除索引前就已登记，删除索引或重置主键失败时
+    立即释放该引用 (恢复已删除的索引) 后再抛出原异常，避免分区长期缺失索引。
+    """
     try:
-        partition_name = get_partition_name(table_base_name)
-        metrics["partition_name"] = partition_name  # <--- 关键点：这里存入字典
+        _acquire_partition(plan, incoming_size_bytes, enable_pk_reset, metrics, index_strategy)
+    except Exception:
+        try:
+            _release_partition(plan, metrics)
+        except Exception:
+            logging.exception("      -> 释放分区失败 (索引可能未恢复)")
+        raise
+
+
+def begin_partition_batch(table_base_name, incoming_size_bytes, enable_pk_reset=False, index_strategy="auto"):
+    """
+    在整个批次开始前持有当前分区: 按批次总数据量决定是否删除索引 (及重置主键)，只做一次。
+    批次内各文件仅增加引用计数，不再逐个删除/恢复；返回 (plan, metrics)，结束时交给 end_partition_batch。
+    """
+    metrics = _new_metrics()
+    plan = prepare_partition(table_base_name, reset_pk=enable_pk_reset)
+    _hold_partition(plan, incoming_size_bytes, enable_pk_reset, metrics, index_strategy)
+    return plan, metrics
+
+
+def end_partition_batch(plan, metrics):
+    """释放批次对分区的持有，若已无文件在导入则恢复索引"""
+    _release_partition(plan, metrics)
+
+
+def import_single_file_with_lock(file_path, table_base_name, enable_pk_reset=False, index_strategy="auto"):
+    """
+    修改后：返回 (CompletedProcess, metrics_dict)
+    """
+
+    metrics = _new_metrics()
+
+    # --- 步骤 1: 获取动态分区表名 (连同索引/主键定义一次取回) ---
+    try:
+        plan = prepare_partition(table_base_name, reset_pk=enable_pk_reset)
+        metrics["partition_name"] = plan.pure_name  # <--- 关键点：这里存入字典 (不带引号)
     except Exception as e:
         return subprocess.CompletedProcess("part", 1, stderr=str(e)), metrics
 
     # --- 步骤 2: 索引处理 ---
-    stored_index_sqls = []
     try:
-        t_start = time.time()
-        stored_index_sqls = backup_and_drop_indexes(partition_name)
-        metrics["time_drop_index"] = time.time() - t_start
-
-        if enable_pk_reset:
-            t_start = time.time()
-            reset_primary_key(partition_name)
-            metrics["time_reset_pk"] = time.time() - t_start
+        _hold_partition(plan, os.path.getsize(file_path), enable_pk_reset, metrics, index_strategy)
     except Exception as e:
-        try:
-            restore_indexes(stored_index_sqls)
-        except:
-            pass
         return subprocess.CompletedProcess("index_opt", 1, stderr=str(e)), metrics
 
-    # --- 步骤 3: 极致速度导入 ---
-    logging.info(f"      [Import] Shell 管道导入...")
+    # --- 步骤 3: libpq COPY 直连导入 ---
+    logging.info("      [Import] libpq COPY 导入...")
 
-    lock_table_name = f'"{table_base_name}_wa"'
-    copy_options = "WITH (FORMAT text, DELIMITER E'|', NULL E'')"
-    copy_cmd_str = f"COPY public.{partition_name}(fid,geom,dtg,taxi_id) FROM STDIN {copy_options};"
+    try:
+        t_start = time.monotonic()
+        metrics["rows_copied"] = _copy_file(file_path, plan.identifier, _lock_wa_sql(table_base_name))
+        metrics["time_copy"] = time.monotonic() - t_start
+        result = subprocess.CompletedProcess(args="copy", returncode=0)
 
-    safe_file_path = shlex.quote(str(file_path))
+    except Exception as e:
+        logging.error("      -> 导入失败: %s", e)
 
-    core_pipeline = (
-        f"("
-        f"echo 'BEGIN;';"
-        f"echo 'LOCK TABLE public.{lock_table_name} IN SHARE UPDATE EXCLUSIVE MODE;';"
-        f"echo {shlex.quote(copy_cmd_str)};"
-        f"cat {safe_file_path};"
-        f"if [ -n \"$(tail -c 1 {safe_file_path})\" ]; then echo ''; fi;"
-        f"echo '\\.'; "
-        f"echo 'COMMIT;'"
-        f") | {build_psql_prefix(interactive=True)} -q -v ON_ERROR_STOP=1"
-    )
+        try:
+            _release_partition(plan, metrics)
+        except Exception:
+            logging.exception("      -> 释放分区失败 (索引可能未恢复)")
+        return subprocess.CompletedProcess(args="copy", returncode=1, stderr=str(e)), metrics
 
-    timed_shell_cmd = (
-        f"ts_start=$(date +%s.%N); "
-        f"{core_pipeline}; "
-        f"exit_code=$?; "
-        f"ts_end=$(date +%s.%N); "
-        f"echo \"TIME_METRIC:$ts_start:$ts_end\" >&2; "
-        f"exit $exit_code"
-    )
+    # --- 步骤 4: 恢复索引 ---
+    try:
+        _release_partition(plan, metrics)
+    except Exception as e:
+        return subprocess.CompletedProcess(args="restore_index", returncode=1, stderr=str(e)), metrics
 
-    copy_duration = 0.0
+    return result, metrics
 
+
+def _import_group(files, table_base_name, enable_pk_reset=False, index_strategy="auto", presort=False):
+    """
+    同一事务内依次导入一组文件，每个文件一个 SAVEPOINT: 单个文件失败只回滚该文件，其余随整组一次提交。
+    提交完成后才返回 [(file_path, CompletedProcess, metrics), ...]；提交失败则整组记为失败。
+    """
+    results = [(fpath, _new_metrics(), [None]) for fpath in files]
+    first_metrics = results[0][1]
     try:
-        result = run_command(timed_shell_cmd, check=False, capture_output=True)
+        plan = prepare_partition(table_base_name, reset_pk=enable_pk_reset)
+        _hold_partition(plan, sum(os.path.getsize(f) for f in files), enable_pk_reset, first_metrics,
+                        index_strategy)
+    except Exception as e:
+        logging.error("      -> 分区准备失败: %s", e)
+        return [(fpath, subprocess.CompletedProcess("part", 1, stderr=str(e)), metrics)
+                for fpath, metrics, _ in results]
 
-        if result.stderr:
-            for line in result.stderr.splitlines():
-                if "TIME_METRIC:" in line:
+    logging.info("      [Import] libpq COPY 导入 %s 个文件 (单事务提交)...", len(files))
+    try:
+        with get_pool().connection() as conn:
+            with conn.transaction():
+                _begin_copy(conn, _lock_wa_sql(table_base_name))
+                for fpath, metrics, error in results:
+                    metrics["partition_name"] = plan.pure_name
+                    t_total = time.monotonic()
                     try:
-                        _, t_start, t_end = line.split(":")
-                        copy_duration = float(t_end) - float(t_start)
-                    except ValueError:
-                        pass
+                        # 嵌套 transaction() 即 SAVEPOINT，出错时只回滚到这里
+                        with conn.transaction(), _presorted(fpath, presort) as source:
+                            t_start = time.monotonic()
+                            metrics["rows_copied"] = _copy_into(conn, source, plan.identifier)
+                            metrics["time_copy"] = time.monotonic() - t_start
+                    except Exception as e:
+                        logging.error("      -> 导入失败 (%s): %s", Path(fpath).name, e)
+                        metrics["rows_copied"] = 0
+                        error[0] = e
+                    metrics["time_total"] = time.monotonic() - t_total
+    except Exception as e:
+        logging.error("      -> 提交失败，整组回滚: %s", e)
+        for _, metrics, error in results:
+            metrics["rows_copied"] = 0
+            error[0] = error[0] or e
+
+    try:
+        _release_partition(plan, results[-1][1])
+    except Exception as e:
+        for _, _, error in results:
+            error[0] = error[0] or e
+    return [(fpath, subprocess.CompletedProcess(args="copy", returncode=0) if error[0] is None
+             else subprocess.CompletedProcess(args="copy", returncode=1, stderr=str(error[0])), metrics)
+            for fpath, metrics, error in results]
+
+
+def _stage_identifier(table_base_name):
+    """暂存表 public._stage_{table} 的 sql.Identifier"""
+    return sql.Identifier("public", _STAGE_TABLE.format(table_base_name))
 
-        metrics["time_copy"] = copy_duration
 
-        if result.returncode != 0:
-            raise subprocess.CalledProcessError(result.returncode, timed_shell_cmd, output=result.stdout,
-                                                stderr=result.stderr)
+def create_stage_table(table_base_name):
+    """按 {table}_wa 的结构新建空的 UNLOGGED 暂存表 (已存在则先删除)"""
+    stage_name = _STAGE_TABLE.format(table_base_name)
+    run_sql_command(_CREATE_STAGE_SQL.format(_stage_identifier(table_base_name),
+                                             sql.Identifier("public", f"{table_base_name}_wa")))
+    logging.info("      [Stage] 已创建暂存表 %s", stage_name)
 
+
+def stage_single_file(file_path, table_base_name):
+    """暂存模式: 仅将文件 COPY 进暂存表，不触碰分区及其索引"""
+    stage_name = _STAGE_TABLE.format(table_base_name)
+    metrics = _new_metrics(stage_name)
+    try:
+        t_start = time.monotonic()
+        metrics["rows_copied"] = _copy_file(file_path, _stage_identifier(table_base_name))
+        metrics["time_copy"] = time.monotonic() - t_start
     except Exception as e:
-        logging.error(f"      -> 导入失败: {e}")
-        if hasattr(e, 'stderr') and e.stderr:
-            logging.error(f"      -> 输出: {e.stderr.strip()}")
+        logging.error("      -> 暂存失败: %s", e)
+        return subprocess.CompletedProcess(args="stage", returncode=1, stderr=str(e)), metrics
+    return subprocess.CompletedProcess(args="stage", returncode=0), metrics
 
-        try:
-            restore_indexes(stored_index_sqls)
-        except:
-            pass
-        return subprocess.CompletedProcess(args="copy", returncode=1, stderr=str(e)), metrics
 
-    # --- 步骤 4: 恢复索引 ---
+def flush_stage(table_base_name, enable_pk_reset=False, index_strategy="auto"):
+    """
+    将暂存表一次性写入当前分区 (单个事务)，随后删除暂存表。
+    返回 (CompletedProcess, metrics_dict)，time_copy / rows_copied 对应 INSERT ... SELECT。
+    """
+    stage_name = _STAGE_TABLE.format(table_base_name)
+    metrics = _new_metrics()
     try:
-        t_start = time.time()
-        restore_indexes(stored_index_sqls)
-        metrics["time_restore_index"] = time.time() - t_start
+        plan = prepare_partition(table_base_name, reset_pk=enable_pk_reset)
+        metrics["partition_name"] = plan.pure_name
+        rows = run_sql_command(_STAGE_SIZE_SQL, fetch_output=True, params=(stage_name,))
+        _hold_partition(plan, rows[0][0], enable_pk_reset, metrics, index_strategy)
     except Exception as e:
-        return subprocess.CompletedProcess(args="restore_index", returncode=1, stderr=str(e)), metrics
+        logging.error("      -> 分区准备失败: %s", e)
+        return subprocess.CompletedProcess(args="flush", returncode=1, stderr=str(e)), metrics
 
+    logging.info("      [Stage] %s -> %s ...", stage_name, plan.pure_name)
+    result = subprocess.CompletedProcess(args="flush", returncode=0)
+    try:
+        t_start = time.monotonic()
+        with get_pool().connection() as conn:
+            with conn.transaction():
+                _begin_copy(conn, _lock_wa_sql(table_base_name))
+                cur = conn.execute(_FLUSH_STAGE_SQL.format(plan.identifier, _COPY_COLUMNS, _COPY_COLUMNS,
+                                                           _stage_identifier(table_base_name)))
+                metrics["rows_copied"] = cur.rowcount
+                logging.info("      -> 写入 %s 行", cur.rowcount)
+        metrics["time_copy"] = time.monotonic() - t_start
+    except Exception as e:
+        logging.error("      -> 写入分区失败: %s", e)
+        result = subprocess.CompletedProcess(args="flush", returncode=1, stderr=str(e))
+
+    try:
+        _release_partition(plan, metrics)
+    except Exception as e:
+        if result.returncode == 0:
+            result = subprocess.CompletedProcess(args="restore_index", returncode=1, stderr=str(e))
+    try:
+        run_sql_command(sql.SQL("DROP TABLE IF EXISTS {}").format(_stage_identifier(table_base_name)))
+    except Exception as e:
+        logging.warning("      -> 删除暂存表失败: %s", e)
     return result, metrics
+
+
+def freeze_import(files, table_base_name, enable_pk_reset=False, index_strategy="auto", presort=False):
+    """
+    COPY FREEZE 导入: 单个事务内先 TRUNCATE 当前分区，再依次 COPY ... FREEZE 全部文件。
+    行在写入时即已冻结，免去日后 VACUUM FREEZE 对整个分区的重写；代价是只能串行、且整批原子提交
+    (任一文件失败则全部回滚)。TRUNCATE 会清空分区现有数据，调用方须确保已 --clean。
+    提交后按文件顺序产出 (file_path, CompletedProcess, metrics)，与 batch_import 一致。
+    """
+    files = list(files)
+    if not files: return
+    results = [(fpath, _new_metrics()) for fpath in files]
+    first_metrics = results[0][1]
+    try:
+        plan = prepare_partition(table_base_name, reset_pk=enable_pk_reset)
+        _hold_partition(plan, sum(os.path.getsize(f) for f in files), enable_pk_reset, first_metrics,
+                        index_strategy)
+    except Exception as e:
+        logging.error("      -> 分区准备失败: %s", e)
+        for fpath, metrics in results:
+            yield fpath, subprocess.CompletedProcess(args="part", returncode=1, stderr=str(e)), metrics
+        return
+
+    logging.info("      [Freeze] TRUNCATE %s 后 COPY FREEZE %s 个文件...",
+                 plan.pure_name, len(files))
+    error = None
+    try:
+        with get_pool().connection() as conn:
+            with conn.transaction():
+                _begin_copy(conn, _lock_wa_sql(table_base_name))
+                conn.execute(sql.SQL("TRUNCATE ONLY {}").format(plan.identifier))
+                for fpath, metrics in results:
+                    metrics["partition_name"] = plan.pure_name
+                    t_total = time.monotonic()
+                    with _presorted(fpath, presort) as source:
+                        t_start = time.monotonic()
+                        metrics["rows_copied"] = _copy_into(conn, source, plan.identifier, freeze=True)
+                        metrics["time_copy"] = time.monotonic() - t_start
+                    metrics["time_total"] = time.monotonic() - t_total
+    except Exception as e:
+        logging.error("      -> 导入失败，整批回滚: %s", e)
+        error = e
+
+    try:
+        _release_partition(plan, results[-1][1])
+    except Exception as e:
+        error = error or e
+    for fpath, metrics in results:
+        if error is None:
+            yield fpath, subprocess.CompletedProcess(args="copy", returncode=0), metrics
+        else:
+            metrics["rows_copied"] = 0
+            yield fpath, subprocess.CompletedProcess(args="copy", returncode=1, stderr=str(error)), metrics
+
+
+def _ensure_pool_capacity(max_workers):
+    """每个 worker 占用一条 COPY 连接，另留一条给元数据查询；预先建立连接，避免首批文件排队握手"""
+    pool = get_pool()
+    if pool.max_size < max_workers + 1 or pool.min_size < max_workers:
+        pool.resize(max(pool.min_size, max_workers), max(pool.max_size, max_workers + 1))
+
+
+def _timed_import(file_path, table_base_name, enable_pk_reset, stage=False, index_strategy="auto", presort=False):
+    t_start = time.monotonic()
+    with _presorted(file_path, presort) as source:
+        if stage:
+            res, metrics = stage_single_file(source, table_base_name)
+        else:
+            res, metrics = import_single_file_with_lock(source, table_base_name, enable_pk_reset=enable_pk_reset,
+                                                        index_strategy=index_strategy)
+    metrics["time_total"] = time.monotonic() - t_start
+    return file_path, res, metrics
+
+
+def batch_import(files, table_base_name, enable_pk_reset=False, max_workers=None, stage=False,
+                 index_strategy="auto", presort=False):
+    """
+    并发导入多个文件，按完成顺序逐个产出 (file_path, CompletedProcess, metrics)。
+    max_workers 缺省为 CPU 核数；为 1 时串行导入。文件按给定顺序提交 (排序由调用方决定)。
+    stage=True 时文件只写入暂存表 (须先 create_stage_table，结束后 flush_stage)。
+    presort=True 时每个文件先按主键前缀排序到临时文件再导入 (仅限文本格式)。
+    COPY_FILES_PER_COMMIT > 1 时 (暂存模式除外) 每组文件共用一个事务，整组完成后才产出该组结果。
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    if COPY_FILES_PER_COMMIT > 1 and not stage:
+        files = list(files)
+        groups = [files[i:i + COPY_FILES_PER_COMMIT] for i in range(0, len(files), COPY_FILES_PER_COMMIT)]
+        if max_workers == 1:
+            for group in groups:
+                yield from _import_group(group, table_base_name, enable_pk_reset, index_strategy, presort)
+            return
+        _ensure_pool_capacity(max_workers)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(_import_group, group, table_base_name, enable_pk_reset, index_strategy,
+                                       presort) for group in groups]
+            for future in as_completed(futures):
+                yield from future.result()
+        return
+
+    if max_workers == 1:
+        files = list(files)
+        for idx, fpath in enumerate(files):
+            # 当前文件 COPY 期间，下一个文件已在后台预读进页缓存
+            if idx + 1 < len(files):
+                _prefetch(files[idx + 1])
+            yield _timed_import(fpath, table_base_name, enable_pk_reset, stage, index_strategy, presort)
+        return
+
+    _ensure_pool_capacity(max_workers)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_timed_import, fpath, table_base_name, enable_pk_reset, stage,
+                                   index_strategy, presort) for fpath in files]
+        for future in as_completed(futures):
+            yield future.result()
@@ -1,31 +1,66 @@
 #!/usr/bin/env python3
+import os
 import sys
 import time
 import logging
 import click
 import re
+import queue
+import shutil
+import threading
 import swanlab
 from pathlib import Path
 from .config import setup_logging, SWANLAB_ENV_SETTINGS
-from .utils import run_sql_command, run_command, build_psql_prefix
-from .loader import import_single_file_with_lock
-from .db_ops import update_cron_jobs
-
-
-def run_main_logic(table, directory, clean, enable_pk_reset):
+from .loader import (batch_import, freeze_import, create_stage_table, flush_stage, begin_partition_batch, end_partition_batch,
+                     INDEX_STRATEGIES)
+from .binary_copy import BINARY_SUFFIX
+from .db_ops import (update_cron_jobs, clear_table, prepare_partition, set_partition_logged, estimate_row_count,
+                     count_rows)
+
+# 默认并发度: CPU 核数，但不超过 8 (再往上通常受限于 WAL 写入)
+DEFAULT_PARALLEL = min(8, os.cpu_count() or 1)
+# 分区名末尾的序号，如 performance_wa_003 -> 003
+_PART_IDX_RE = re.compile(r'(\d+)$')
+
+
+def _start_swanlab_logger():
+    """
+    启动后台线程串行调用 swanlab.log，导入主循环只需入队，不必等待 SwanLab 的序列化与上传。
+    返回 (队列, 线程)；放入 None 表示结束，调用方需 join 线程以确保记录全部写出。
+    """
+    log_queue = queue.Queue()
+
+    def _worker():
+        while True:
+            item = log_queue.get()
+            if item is None:
+                return
+            payload, step = item
+            try:
+                swanlab.log(payload, step=step)
+            except Exception as e:
+                logging.warning("SwanLab 记录失败: %s", e)
+
+    worker = threading.Thread(target=_worker, name="swanlab-log", daemon=True)
+    worker.start()
+    return log_queue, worker
+
+
+def run_main_logic(table, directory, clean, enable_pk_reset, file_format="text", parallel=1, stage=False,
+                   index_strategy="auto", unlogged_load=False, order="auto", cascade=False,
+                   exact_count=False, freeze=False, presort=False):
     """通用业务逻辑控制器"""
     setup_logging()
 
     # 更新定时任务
     update_cron_jobs(table)
 
-    tbl_dir = Path(directory)
     mode_name = "Collatec Mode" if enable_pk_reset else "Standard Mode"
     full_mode_desc = "Collatec Mode (含主键重置)" if enable_pk_reset else "Standard Mode (基础模式)"
 
     logging.info("=" * 60)
-    start_time = time.time()
-    logging.info(f"开始数据导入流程 - {full_mode_desc}")
+    start_time = time.monotonic()
+    logging.info("开始数据导入流程 - %s", full_mode_desc)
     logging.info("=" * 60)
 
     # ==========================
@@ -38,7 +73,17 @@ def run_main_logic(table, directory, clean, enable_pk_reset):
         "Task/Data_Directory": str(directory),
         "Task/Clean_Start": clean,
         "Task/Enable_PK_Reset": enable_pk_reset,
-        "Task/Mode": mode_name
+        "Task/Mode": mode_name,
+        "Task/File_Format": file_format,
+        "Task/Parallel": parallel,
+        "Task/Stage": stage,
+        "Task/Index_Strategy": index_strategy,
+        "Task/Unlogged_Load": unlogged_load,
+        "Task/Order": order,
+        "Task/Cascade": cascade,
+        "Task/Exact_Count": exact_count,
+        "Task/Freeze": freeze,
+        "Task/Presort": presort
     }
 
     # 2. 合并环境变量配置 (除去密码)
@@ -54,114 +99,239 @@ def run_main_logic(table, directory, clean, enable_pk_reset):
 
     if clean:
         # ... (后续代码保持完全一致，不需要修改) ...
-        logging.info(f"\n>>> 阶段 1: 清空表 '{table}'...")
+        logging.info("\n>>> 阶段 1: 清空表 '%s'...", table)
         try:
-            run_sql_command(f"DELETE FROM \"public\".\"{table}\";")
+            clear_table(table, cascade=cascade)
             logging.info("表已清空。")
         except Exception as e:
-            logging.error(f"清空失败: {e}")
+            logging.error("清空失败: %s", e)
             sys.exit(1)
     else:
-        logging.info(f"\n>>> 阶段 1: 跳过清空...")
-
-    tbl_files = sorted(tbl_dir.glob("*.tbl"))
-    if not tbl_files:
-        logging.error("未找到 .tbl 文件。")
+        logging.info("\n>>> 阶段 1: 跳过清空...")
+
+    suffix = BINARY_SUFFIX if file_format == "binary" else ".tbl"
+    # scandir 一次拿到文件名与大小，后续排序、批次数据量估算不再逐个 stat
+    with os.scandir(directory) as it:
+        entries = [(e.name, e.path, e.stat().st_size) for e in it if e.name.endswith(suffix) and e.is_file()]
+    if not entries:
+        logging.error("未找到 %s 文件。", suffix)
         sys.exit(1)
-    logging.info(f"共 {len(tbl_files)} 个文件。")
-
-    logging.info(f"\n>>> 阶段 2: 导入处理...")
+    # auto: 串行按文件名，并行按大小从大到小 (最长处理时间优先，减少尾部空等)
+    if order == "size" or (order == "auto" and parallel > 1):
+        entries.sort(key=lambda entry: -entry[2])
+    else:
+        entries.sort()
+    tbl_files = [Path(path) for _, path, _ in entries]
+    total_bytes = sum(size for _, _, size in entries)
+    total_files = len(tbl_files)
+    logging.info("共 %d 个文件。", total_files)
+
+    if freeze and (stage or not clean):
+        # FREEZE 依赖同一事务内 TRUNCATE 分区: 未清空时会误删已有数据，暂存模式则由 INSERT 写入分区
+        logging.warning("--freeze 需配合 --clean 且不能与 --stage 同用，已忽略")
+        freeze = False
+    if freeze:
+        parallel = 1
+    if presort and (file_format != "text" or shutil.which("sort") is None):
+        logging.warning("--presort 仅支持文本格式且需要 GNU sort，已忽略")
+        presort = False
+    logging.info("\n>>> 阶段 2: 导入处理 (并行度: %d)...", parallel)
     success, fail, total_copy_time = 0, 0, 0.0
+    total_rows = 0  # 本次实际写入分区的行数 (取自 COPY / INSERT 的返回计数)
 
-    for i, fpath in enumerate(tbl_files, 1):
-        logging.info(f"  -> ({i}/{len(tbl_files)}) {fpath.name}")
-        p_start = time.time()
-
-        # === 调用 Loader ===
-        res, metrics = import_single_file_with_lock(fpath, table, enable_pk_reset=enable_pk_reset)
-
-        file_process_time = time.time() - p_start
-        copy_t = metrics.get("time_copy", 0.0)
-        partition_name = metrics.get("partition_name", "N/A")
-
-        # ==========================
-        # SwanLab Logging
-        # ==========================
-
-        log_payload = {
-            "Time/Total_Process": file_process_time,
-            "Time/Drop_Index": metrics.get("time_drop_index", 0.0),
-            "Time/Copy_Data": copy_t,
-            "Time/Restore_Index": metrics.get("time_restore_index", 0.0),
-            "Status": 1 if res.returncode == 0 else 0
-        }
-
-        if enable_pk_reset:
-            log_payload["Time/Reset_PK"] = metrics.get("time_reset_pk", 0.0)
+    # 导入期间分区不写 WAL，批次结束后 (无论成败) 切回 LOGGED
+    unlogged_plan = None
+    if unlogged_load:
+        try:
+            unlogged_plan = prepare_partition(table)
+            set_partition_logged(unlogged_plan, logged=False)
+        except Exception as e:
+            logging.warning("切换 UNLOGGED 失败，按常规方式导入: %s", e)
+            unlogged_plan = None
 
-        clean_part_name = partition_name.replace('"', '')
-        log_payload["Info/Partition_Name"] = swanlab.Text(clean_part_name, caption=f"File: {fpath.name}")
+    # 索引 (及主键) 在整个批次内只删除/恢复一次，而不是每个文件各做一遍
+    batch_plan, batch_metrics = None, {}
+    try:
+        batch_plan, batch_metrics = begin_partition_batch(
+            table, total_bytes,
+            enable_pk_reset=enable_pk_reset, index_strategy=index_strategy)
+    except Exception as e:
+        logging.warning("批次级索引处理失败，改为逐文件处理: %s", e)
 
-        try:
-            match = re.search(r'(\d+)$', clean_part_name)
-            if match:
-                part_idx = int(match.group(1))
-                log_payload["Info/Partition_Index"] = part_idx
-        except:
-            pass
-
-        swanlab.log(log_payload, step=i)
-
-        if res.returncode == 0:
-            success += 1
-            total_copy_time += copy_t
-            logging.info(f"     ✅ 成功 (Shell COPY: {copy_t:.2f}s | 全程: {file_process_time:.2f}s)")
+    log_queue, log_worker = _start_swanlab_logger()
+    try:
+        if stage:
+            try:
+                create_stage_table(table)
+            except Exception as e:
+                logging.error("创建暂存表失败: %s", e)
+                sys.exit(1)
+
+        # === 调用 Loader (并行时按完成顺序返回) ===
+        if freeze:
+            results = freeze_import(tbl_files, table, enable_pk_reset=enable_pk_reset, index_strategy=index_strategy,
+                                    presort=presort)
         else:
-            fail += 1
-            logging.error(f"     ❌ 失败")
-
-    logging.info(f"\n>>> 阶段 3: 统计 ({full_mode_desc})...")
-    real_time = time.time() - start_time
-    logging.info(f"总耗时: {real_time:.3f}s | 纯COPY耗时: {total_copy_time:.3f}s")
+            results = batch_import(tbl_files, table, enable_pk_reset=enable_pk_reset, max_workers=parallel,
+                                   stage=stage, index_strategy=index_strategy, presort=presort)
+        for i, (fpath, res, metrics) in enumerate(results, 1):
+            logging.info("  -> (%d/%d) %s", i, total_files, fpath.name)
+            file_process_time = metrics.get("time_total", 0.0)
+            copy_t = metrics.get("time_copy", 0.0)
+            partition_name = metrics.get("partition_name", "N/A")
+
+            # ==========================
+            # SwanLab Logging
+            # ==========================
+
+            log_payload = {
+                "Time/Total_Process": file_process_time,
+                "Time/Drop_Index": metrics.get("time_drop_index", 0.0),
+                "Time/Copy_Data": copy_t,
+                "Time/Restore_Index": metrics.get("time_restore_index", 0.0),
+                "Status": 1 if res.returncode == 0 else 0
+            }
+
+            if enable_pk_reset:
+                log_payload["Time/Reset_PK"] = metrics.get("time_reset_pk", 0.0)
+
+            log_payload["Info/Partition_Name"] = swanlab.Text(partition_name, caption=f"File: {fpath.name}")
+
+            try:
+                match = _PART_IDX_RE.search(partition_name)
+                if match:
+                    part_idx = int(match.group(1))
+                    log_payload["Info/Partition_Index"] = part_idx
+            except (ValueError, AttributeError):
+                pass
+
+            log_queue.put((log_payload, i))
+
+            if res.returncode == 0:
+                success += 1
+                total_copy_time += copy_t
+                rows_copied = metrics.get("rows_copied", 0)
+                if not stage:
+                    total_rows += rows_copied
+                logging.info("     ✅ 成功 (%d 行 | COPY: %.2fs | 全程: %.2fs)", rows_copied, copy_t, file_process_time)
+            else:
+                fail += 1
+                logging.error("     ❌ 失败")
+
+        if stage:
+            logging.info("  -> 暂存表写入分区...")
+            res, metrics = flush_stage(table, enable_pk_reset=enable_pk_reset, index_strategy=index_strategy)
+            flush_t = metrics.get("time_copy", 0.0)
+            log_queue.put(({
+                "Time/Flush_Stage": flush_t,
+                "Time/Drop_Index": metrics.get("time_drop_index", 0.0),
+                "Time/Restore_Index": metrics.get("time_restore_index", 0.0),
+                "Status": 1 if res.returncode == 0 else 0
+            }, None))
+            if res.returncode == 0:
+                total_copy_time += flush_t
+                total_rows = metrics.get("rows_copied", 0)
+                logging.info("     ✅ 成功 (INSERT: %.2fs)", flush_t)
+            else:
+                logging.error("     ❌ 失败，暂存数据未写入分区")
+    finally:
+        log_queue.put(None)
+        if batch_plan is not None:
+            try:
+                end_partition_batch(batch_plan, batch_metrics)
+            except Exception as e:
+                logging.error("恢复索引失败: %s", e)
+        if unlogged_plan is not None:
+            try:
+                set_partition_logged(unlogged_plan, logged=True)
+            except Exception as e:
+                logging.error("恢复 LOGGED 失败，请手动执行 ALTER TABLE ... SET LOGGED: %s", e)
+        # 索引恢复期间后台线程已在写出，这里只等待剩余记录
+        log_worker.join()
+
+    logging.info("\n>>> 阶段 3: 统计 (%s)...", full_mode_desc)
+    real_time = time.monotonic() - start_time
+    logging.info("总耗时: %.3fs | 纯COPY耗时: %.3fs", real_time, total_copy_time)
 
     try:
-        res = run_command(build_psql_prefix() + f" -t -c 'SELECT count(1) FROM \"public\".\"{table}\";'", check=False,
-                          capture_output=True)
-        cnt = int(res.stdout.strip()) if res.stdout.strip().isdigit() else 0
-        logging.info(f"最终行数: {cnt}")
+        if total_rows > 0:
+            logging.info("导入行数: %d", total_rows)
+        if exact_count:
+            # 总行数以全表 count 为准，导入行数只用于计算吞吐量
+            cnt = count_rows(table)
+            logging.info("最终行数: %d", cnt)
+        else:
+            # 按统计信息估算，不做全表扫描
+            cnt = estimate_row_count(table)
+            logging.info("最终行数 (估算): %d", cnt)
 
-        throughput_total = int(cnt / real_time) if real_time > 0 else 0
-        throughput_copy = int(cnt / total_copy_time) if total_copy_time > 0 else 0
+        # 吞吐量只按本次导入的行数计算，表中原有的行不计入
+        loaded = total_rows
+        throughput_total = int(loaded / real_time) if real_time > 0 else 0
+        throughput_copy = int(loaded / total_copy_time) if total_copy_time > 0 else 0
 
-        if cnt > 0:
-            logging.info(f"平均吞吐量 (Total): {throughput_total} rows/s")
+        if loaded > 0:
+            logging.info("平均吞吐量 (Total): %d rows/s", throughput_total)
             if total_copy_time > 0:
-                logging.info(f"纯COPY吞吐量 (Copy):  {throughput_copy} rows/s")
+                logging.info("纯COPY吞吐量 (Copy):  %d rows/s", throughput_copy)
 
         swanlab.log({
             "Summary/Total_Rows": cnt,
+            "Summary/Imported_Rows": total_rows,
             "Summary/Throughput_Global": throughput_total,
             "Summary/Throughput_PureCopy": throughput_copy,
-            "Summary/Total_Duration_Sec": real_time
+            "Summary/Total_Duration_Sec": real_time,
+            "Summary/Time_Drop_Index": batch_metrics.get("time_drop_index", 0.0),
+            "Summary/Time_Reset_PK": batch_metrics.get("time_reset_pk", 0.0),
+            "Summary/Time_Restore_Index": batch_metrics.get("time_restore_index", 0.0)
         })
 
     except Exception as e:
-        logging.warning(f"统计失败: {e}")
+        logging.warning("统计失败: %s", e)
 
     swanlab.finish()
 
 
 @click.command()
 @click.option('-f', '--table', required=True, help="目标表名")
-@click.option('-d', '--directory', required=True, type=click.Path(exists=True, file_okay=False), help="数据目录")
-@click.option('--clean/--no-clean', default=True, help="导入前清空表")
-def cli_standard(table, directory, clean):
-    run_main_logic(table, directory, clean, enable_pk_reset=False)
-
-
-@click.command()
-@click.option('-f', '--table', required=True, help="目标表名")
-@click.option('-d', '--directory', required=True, type=click.Path(exists=True, file_okay=False), help="数据目录")
+@click.option('-d', '--directory', required=True,
+              type=click.Path(exists=True, file_okay=False, path_type=Path, resolve_path=True),
+              help="数据目录")
 @click.option('--clean/--no-clean', default=True, help="导入前清空表")
-def cli_collatec(table, directory, clean):
-    run_main_logic(table, directory, clean, enable_pk_reset=True)
\ No newline at end of file
+@click.option('--cascade/--no-cascade', default=False,
+              help="清空时 TRUNCATE ... CASCADE，一并清空通过外键引用数据表的其他表")
+@click.option('--pk-reset/--no-pk-reset', default=False, show_default=True,
+              help="Collatec 模式: 导入前重置分区主键")
+@click.option('--format', 'file_format', type=click.Choice(["text", "binary"]), default="text",
+              help="输入格式: text 导入 .tbl，binary 导入 gstria-ppg-text2bin 生成的 .bin")
+@click.option('--parallel', '--jobs', 'parallel', type=click.IntRange(min=1), default=DEFAULT_PARALLEL,
+              show_default=True, help="并发导入的文件数 (1 为串行，便于调试)")
+@click.option('--stage/--no-stage', default=False,
+              help="先 COPY 进 UNLOGGED 暂存表，全部完成后一次性写入分区")
+@click.option('--index-strategy', type=click.Choice(INDEX_STRATEGIES), default="auto", show_default=True,
+              help="辅助索引处理: auto 按数据量判定，always-drop 总是删除重建，never-drop 保留索引直接导入")
+@click.option('--unlogged-load/--no-unlogged-load', default=False,
+              help="导入期间将当前分区设为 UNLOGGED，结束后 SET LOGGED (两次整表重写，崩溃时分区数据丢失)")
+@click.option('--exact-count/--no-exact-count', default=False,
+              help="结束时 count(1) 全表得到精确总行数 (大表需全表扫描)")
+@click.option('--freeze/--no-freeze', default=False,
+              help="单事务内 TRUNCATE 当前分区后 COPY FREEZE 全部文件 (串行、整批原子提交，需 --clean)")
+@click.option('--presort/--no-presort', default=False,
+              help="导入前用 GNU sort 将每个 .tbl 按主键前缀 (fid, dtg) 排序到临时文件，主键 B-tree 近似顺序写入")
+@click.option('--order', type=click.Choice(["auto", "name", "size"]), default="auto", show_default=True,
+              help="导入顺序: name 按文件名，size 按大小从大到小；auto 串行按文件名、并行按大小")
+def cli(table, directory, clean, cascade, pk_reset, file_format, parallel, stage, index_strategy, unlogged_load,
+        exact_count, freeze, presort, order):
+    run_main_logic(table, directory, clean, enable_pk_reset=pk_reset, file_format=file_format, parallel=parallel,
+                   stage=stage, index_strategy=index_strategy, unlogged_load=unlogged_load, order=order,
+                   cascade=cascade, exact_count=exact_count, freeze=freeze, presort=presort)
+
+
+def cli_standard():
+    """gstria-ppg-batch-load 入口: 默认不重置主键"""
+    cli(default_map={"pk_reset": False})
+
+
+def cli_collatec():
+    """gstria-ppg-batch-load-collatec 入口: 默认重置主键"""
+    cli(default_map={"pk_reset": True})
@@ -1,56 +1,61 @@
-import subprocess
-import shlex
 import logging
-import os
-from .config import DB_USER, DB_NAME, CONTAINER_NAME, PG_HOST, PG_PORT, DB_PASSWORD
+import atexit
+import threading
+from psycopg.conninfo import make_conninfo
+from psycopg_pool import ConnectionPool
+from .config import PG_CONNINFO, INDEX_RESTORE_PARALLEL, PG_SESSION_SETTINGS
 
+_pool = None
+_pool_lock = threading.Lock()
 
-def build_psql_prefix(interactive=False):
-    """
-    构建 psql 命令前缀。
-
-    模式 A (Docker): docker exec -i <container> psql -U <user> -d <db>
-    模式 B (Direct): psql -h <host> -p <port> -U <user> -d <db>
-    """
-    flags = "-i" if interactive else ""
 
-    if CONTAINER_NAME:
-        # Docker 模式：通常直接在容器内连接，不需要指定 -h/-p (默认为 socket 或 localhost)
-        return f"docker exec {flags} {CONTAINER_NAME} psql -U {DB_USER} -d {DB_NAME}"
-    else:
-        # 直连模式：必须指定 Host 和 Port
-        # 注意：-h 和 -p 参数放在前面比较规范
-        return f"psql -h {PG_HOST} -p {PG_PORT} -U {DB_USER} -d {DB_NAME}"
+def _configure_connection(conn):
+    """新连接入池前应用 PG_SESSION_SETTINGS (会话级，连接存续期间有效)"""
+    if not PG_SESSION_SETTINGS: return
+    for name, value in PG_SESSION_SETTINGS:
+        conn.execute("SELECT set_config(%s, %s, false)", (name, value))
+    conn.commit()
 
 
-def run_command(cmd, check=True, capture_output=False, env=None):
+def set_local_settings(conn, settings):
     """
-    增加 env 参数支持，用于安全传递复杂字符串
+    在 conn 的当前事务内以 set_config(name, value, true) 设置参数 (等同 SET LOCAL，事务结束后恢复)。
+    settings 为 [(name, value), ...]，名称与取值均走 %s 参数，合并为一条 SELECT 发送。
     """
-    # 如果没有传入 env，默认使用当前系统环境变量
-    run_env = env if env is not None else os.environ.copy()
+    if not settings: return
+    conn.execute("SELECT " + ", ".join(["set_config(%s, %s, true)"] * len(settings)),
+                 [item for pair in settings for item in pair])
 
-    if DB_PASSWORD:
-        run_env["PGPASSWORD"] = DB_PASSWORD
 
+def get_pool():
+    """
+    获取进程级 psycopg 连接池 (首次调用时创建)。
+
+    所有 SQL 与 COPY 均通过 libpq 直连 PG_HOST:PG_PORT，连接在整个批次内复用，
+    不再为每条语句启动 psql / docker exec 进程。
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # 并行恢复索引时每个线程各占一条连接，另留一条给主流程
+            max_size = max(4, INDEX_RESTORE_PARALLEL + 1)
+            _pool = ConnectionPool(make_conninfo(**PG_CONNINFO), min_size=1, max_size=max_size,
+                                   configure=_configure_connection, open=True)
+            atexit.register(_pool.close)
+    return _pool
+
+
+def run_sql_command(sql, fetch_output=False, params=None):
+    """
+    在连接池中的持久连接上执行 SQL (可包含多条语句，同一事务内执行)；sql 可为字符串或 psycopg.sql 组合对象。
+    params 非空时以 %s 占位符参数化执行，此时 sql 只能是单条语句。
+    fetch_output=True 时返回结果行列表 [(col1, col2, ...), ...]
+    """
     try:
-        result = subprocess.run(
-            cmd,
-            shell=True,
-            check=check,
-            capture_output=capture_output,
-            text=True,
-            env=run_env
-        )
-        return result
-    except subprocess.CalledProcessError as e:
-        logging.error(f"Cmd Failed: {e.cmd}")
-        if capture_output and e.stderr: logging.error(f"Stderr: {e.stderr.strip()}")
+        with get_pool().connection() as conn:
+            cur = conn.execute(sql, params)
+            if fetch_output:
+                return cur.fetchall()
+    except Exception as e:
+        logging.error("SQL Failed: %s", sql)
         raise e
-
-
-def run_sql_command(sql, fetch_output=False):
-    base_cmd = build_psql_prefix(interactive=False)
-    flags = " -tA" if fetch_output else ""
-    cmd = f"{base_cmd}{flags} -c {shlex.quote(sql)}"
-    return run_command(cmd, capture_output=fetch_output)